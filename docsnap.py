@@ -9,7 +9,7 @@ USAGE:
     python3 docsnap.py --start-url https://docs.flutter.dev --output flutter_docs.pdf
 
 DEPENDENCIES (install with pip):
-    pip install requests beautifulsoup4 markdownify markdown weasyprint tqdm
+    pip install aiohttp requests lxml markdownify markdown weasyprint pypdf tqdm
 
 NOTES:
   - WeasyPrint requires some system libraries (cairo, Pango, GDK-PixBuf). On Debian/Ubuntu:
@@ -17,35 +17,79 @@ NOTES:
     - On macOS, install Cairo and Pango via Homebrew.
   - This script respects robots.txt and will only crawl allowed paths.
   - The script tries to extract the main content from each page (main/article/div[role=main]).
+  - Images are downloaded once into a local cache (--cache-dir) before the PDF is rendered.
+  - Pages are fetched concurrently (--concurrency workers); --delay spaces out requests per host.
   - For large sites, crawling may take long; you can provide a list of specific URLs instead.
 """
 
 import argparse
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
 import os
+import pathlib
 import re
+import sqlite3
 import sys
+import tempfile
 import time
 import urllib.parse as urlparse
 from collections import OrderedDict
 
+import aiohttp
+import lxml.html
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
 from markdownify import markdownify as md
 from markdown import markdown as md_to_html
+from pypdf import PdfReader, PdfWriter
+from pypdf.annotations import Link
+from pypdf.generic import Fit
 from weasyprint import HTML, CSS
 from tqdm import tqdm
 from urllib.robotparser import RobotFileParser
 
 # -------------------- Helper utilities --------------------
 
+USER_AGENT = "doc-builder/1.0 (+https://example.com)"
+
 SESSION = requests.Session()
 SESSION.headers.update({
-    "User-Agent": "doc-builder/1.0 (+https://example.com)"
+    "User-Agent": USER_AGENT,
+    # Every compression scheme urllib3 can decode here (gzip/deflate, plus br/zstd when available)
+    "Accept-Encoding": ACCEPT_ENCODING,
 })
+# Keep connections alive across requests and retry transient failures with back-off
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                       max_retries=Retry(total=3, backoff_factor=0.5,
+                                         status_forcelist=[429, 500, 502, 503, 504],
+                                         raise_on_status=False))
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
+
+_ESC = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"})
+
+def esc(s):
+    # HTML-escape text and attribute values for the generated book markup
+    return s.translate(_ESC)
+
+@functools.lru_cache(maxsize=1024)
+def _split(url):
+    # The same nav links recur on every page; urlsplit skips urlparse's ;params pass
+    return urlparse.urlsplit(url)
 
 def is_same_domain(start_netloc, link):
     try:
-        p = urlparse.urlparse(link)
+        p = _split(link)
         if not p.netloc:
             return True
         return p.netloc == start_netloc
@@ -55,151 +99,465 @@ def is_same_domain(start_netloc, link):
 def normalize_link(base, href):
     if not href:
         return None
-    href = href.split('#')[0]  # drop fragment
     href = href.strip()
-    if href.startswith('mailto:') or href.startswith('tel:'):
+    # A bare #fragment points back at the page itself
+    if not href or href[0] == '#' or href.startswith(('mailto:', 'tel:', 'javascript:')):
         return None
+    i = href.find('#')
+    if i != -1:
+        href = href[:i]  # drop fragment
     return urlparse.urljoin(base, href)
 
+def parse_robots(robots_url, status, text):
+    """
+    Build a RobotFileParser from a fetched robots.txt. Status handling follows
+    RobotFileParser.read(), except that server errors allow everything instead of
+    silently disallowing every URL.
+    """
+    rp = RobotFileParser(robots_url)
+    if status in (401, 403):
+        rp.disallow_all = True
+    elif 200 <= status < 300:
+        rp.parse(text.splitlines())
+    else:
+        rp.allow_all = True
+    return rp
+
+@functools.lru_cache(maxsize=32)
+def _robot_parser(scheme_netloc):
+    # Fetched through SESSION, so robots.txt sees our User-Agent like every other request
+    robots_url = f"{scheme_netloc}/robots.txt"
+    resp = SESSION.get(robots_url, timeout=20)
+    return parse_robots(robots_url, resp.status_code, resp.text)
+
 def allowed_by_robots(start_url, url):
     try:
-        parsed = urlparse.urlparse(start_url)
-        robots_url = f"{parsed.scheme}://{parsed.netloc}/robots.txt"
-        rp = RobotFileParser()
-        rp.set_url(robots_url)
-        rp.read()
-        return rp.can_fetch(SESSION.headers['User-Agent'], url)
+        parsed = urlparse.urlsplit(start_url)
+        return _robot_parser(f"{parsed.scheme}://{parsed.netloc}").can_fetch(USER_AGENT, url)
     except Exception:
         return True  # be permissive if robots parsing fails
 
-def extract_main_html(soup):
+async def fetch_robot_parser(session, start_url):
+    """
+    Fetch robots.txt for start_url's host once over the crawl session.
+    Returns a RobotFileParser, or None if it could not be fetched.
+    """
+    parsed = urlparse.urlsplit(start_url)
+    robots_url = f"{parsed.scheme}://{parsed.netloc}/robots.txt"
+    try:
+        async with session.get(robots_url) as resp:
+            return parse_robots(robots_url, resp.status, await resp.text(errors="replace"))
+    except Exception:
+        return None  # be permissive if robots parsing fails
+
+_SKIP_EXT_RE = re.compile(r'\.(?:jpe?g|png|gif|svg|pdf|zip|tar|gz|mp4|webm)$', re.I)
+_HEADING_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+_H13_TAGS = ("h1", "h2", "h3")
+_SAFEID_RE = re.compile(r'[^a-zA-Z0-9_-]+')
+
+# Main-content candidates, tried in priority order
+_MAIN_XPATHS = [etree.XPath(xp) for xp in (
+    "//main",
+    "//article",
+    "//div[@role='main']",
+    "//div[contains(@class, 'content')]",
+    "//div[contains(@class, 'main-content')]",
+    "//div[contains(@id, 'content')]",
+)]
+
+def _has_class(cls):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')"
+
+_JUNK_TAGS = ("script", "style", "link", "nav", "form", "footer", "header", "noscript")
+# Matched as class tokens, so "nav" here catches <div class="nav"> as well as the <nav> tag above
+_JUNK_CLASSES = frozenset(["edit-on-github", "sidebar", "toc", "breadcrumbs", "page-nav", "nav",
+                           "site-footer", "site-header"])
+
+# All junk tags and classes in one libxml2 query
+_JUNK_XP = etree.XPath(
+    " | ".join(f".//{tag}" for tag in _JUNK_TAGS) +
+    " | .//*[" + " or ".join(_has_class(cls) for cls in sorted(_JUNK_CLASSES)) + "]")
+
+# Plain str results: no back-reference to the element is kept for each href
+_HREF_XP = etree.XPath("//a/@href", smart_strings=False)
+
+def parse_content_type(header):
+    """
+    Split a Content-Type header into (mime type, charset or None).
+    """
+    mime, *params = header.split(";")
+    charset = None
+    for param in params:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "charset":
+            charset = value.strip().strip("'\"") or None
+    return mime.strip().lower(), charset
+
+def is_html_type(mime):
+    # A missing Content-Type is given the benefit of the doubt
+    return mime in ("", "text/html", "application/xhtml+xml")
+
+@functools.lru_cache(maxsize=16)
+def _html_parser(encoding):
+    # Comments are dropped while parsing rather than by a later tree walk
+    try:
+        return lxml.html.HTMLParser(encoding=encoding, remove_comments=True)
+    except LookupError:
+        return lxml.html.HTMLParser(remove_comments=True)  # unknown charset: let libxml2 sniff <meta>
+
+def parse_document(body, encoding=None):
+    """
+    Parse raw response bytes straight into an lxml document, decoding in libxml2.
+    Without an explicit encoding the page's <meta charset> is honoured.
+    """
+    return lxml.html.document_fromstring(body, parser=_html_parser(encoding))
+
+def page_title(tree, url):
+    title_tag = tree.find(".//title")
+    return title_tag.text_content().strip() if title_tag is not None else url
+
+def extract_main_html(tree):
     # Try several fallbacks to locate the main content
-    selectors = [
-        ("main", None),
-        ("article", None),
-        ("div[role=main]", None),
-        ("div[class*='content']", None),
-        ("div[class*='main-content']", None),
-        ("div[id*='content']", None),
-    ]
-    for sel, _ in selectors:
-        try:
-            tag = soup.select_one(sel)
-        except Exception:
-            tag = None
-        if tag and tag.get_text(strip=True):
-            return tag
+    for xp in _MAIN_XPATHS:
+        found = xp(tree)
+        if found and found[0].text_content().strip():
+            return found[0]
     # Fallback: body
-    return soup.body or soup
+    body = tree.find("body")
+    return body if body is not None else tree
 
 def clean_html_fragment(fragment):
-    # Remove scripts, styles, navs, forms
-    for tag in fragment.select("script, style, nav, form, footer, header, noscript"):
-        tag.decompose()
-    # Remove common junk by classes or ids
-    for cls in ["edit-on-github", "sidebar", "toc", "breadcrumbs", "page-nav", "nav", "site-footer", "site-header"]:
-        for t in fragment.select(f".{cls}"):
-            t.decompose()
-    # Remove comments
-    for comment in fragment.find_all(string=lambda text: isinstance(text, type(fragment.original_encoding))):
-        pass
+    for tag in _JUNK_XP(fragment):
+        tag.drop_tree()
     return fragment
 
+def resolve_image_urls(fragment, page_url):
+    # Image paths are relative to their page, not to the book's base URL
+    for img in fragment.iter("img"):
+        src = (img.get("src") or "").strip()
+        if src and not src.startswith("data:"):
+            img.set("src", urlparse.urljoin(page_url, src))
+
+def serialize_fragment(fragment):
+    return etree.tostring(fragment, encoding="unicode", method="html", with_tail=False)
+
+def parse_fragment(html_content):
+    # A <body> fragment loses its <body> tag: lxml returns its only child element,
+    # or wraps several children in a <div> (bare text in a <span>)
+    return lxml.html.fromstring(html_content)
+
+def content_digest(fragment):
+    # Whitespace-normalised text, so the same page reached by several URLs hashes alike
+    text = " ".join(fragment.text_content().split())
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def _parse_and_clean(url, body, charset=None):
+    """
+    CPU-bound half of processing a page, run in a worker process.
+    Returns (title, cleaned_html, links, digest) or None if no content was found;
+    lxml trees are not picklable, so only strings cross the process boundary.
+    """
+    tree = parse_document(body, charset)
+    title = page_title(tree, url)
+    main = extract_main_html(tree)
+    if main is None:
+        return None
+    main = clean_html_fragment(main)
+    resolve_image_urls(main, url)
+    # De-duplicated here so repeated nav links are not pickled back to the crawler
+    links = list(dict.fromkeys(filter(None, (normalize_link(url, raw_href) for raw_href in _HREF_XP(tree)))))
+    return title, serialize_fragment(main), links, content_digest(main)
+
 # -------------------- Crawler and assembler --------------------
 
-def crawl_docs(start_url, max_pages=300, delay=0.5, allowed_path_prefix=None):
+class PageCache:
+    """
+    sqlite3-backed cache of processed pages, kept between runs so re-crawls can
+    revalidate with If-None-Match / If-Modified-Since instead of re-downloading.
+    Entries are (etag, last_modified, parsed_page) with parsed_page as returned
+    by _parse_and_clean, so a 304 skips both the download and the parse.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, "
+                         "last_modified TEXT, title TEXT, html TEXT, links TEXT, digest BLOB)")
+
+    def get(self, url):
+        row = self._db.execute("SELECT etag, last_modified, title, html, links, digest FROM pages "
+                               "WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, title, html_content, links, digest = row
+        return etag, last_modified, (title, html_content, json.loads(links), digest)
+
+    def put(self, url, etag, last_modified, parsed_page):
+        if not (etag or last_modified):
+            return  # nothing to revalidate with
+        title, html_content, links, digest = parsed_page
+        self._db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (url, etag, last_modified, title, html_content, json.dumps(links), digest))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+def conditional_headers(entry):
+    if entry is None:
+        return {}
+    etag, last_modified, _ = entry
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+class HostRateLimiter:
+    """
+    Spaces out request starts to each host by at least `delay` seconds,
+    so concurrent workers overlap latency without hammering the server.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self._next_slot = {}
+
+    async def wait(self, host):
+        if self.delay <= 0:
+            return
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next_slot.get(host, now))
+        self._next_slot[host] = start + self.delay
+        if start > now:
+            await asyncio.sleep(start - now)
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings: a few bytes per URL instead of a full
+    str in a set. Once `capacity` items are added, about `error_rate` of unseen
+    items are wrongly reported as present; there are no false negatives.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: k bit positions from one 128-bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, item):
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    def add(self, item):
+        for p in self._positions(item):
+            self._bits[p >> 3] |= 1 << (p & 7)
+
+# Crawls of at least this many pages track queued URLs in a BloomFilter
+BLOOM_MIN_PAGES = 100_000
+
+async def crawl_docs_async(start_url, max_pages=300, delay=0.5, allowed_path_prefix=None, concurrency=8,
+                           respect_robots=True, workers=None, page_cache=None):
     """
-    Crawl internal pages starting from start_url.
-    Returns OrderedDict of URL -> (title, html_content)
+    Crawl internal pages starting from start_url with `concurrency` aiohttp workers.
+    Parsing and cleaning run in a pool of `workers` processes (default: CPU count).
+    With a PageCache, unchanged pages are revalidated rather than re-downloaded.
+    Returns OrderedDict of URL -> (title, content element), in crawl order.
     """
-    parsed = urlparse.urlparse(start_url)
+    parsed = urlparse.urlsplit(start_url)
     base_netloc = parsed.netloc
     scheme_and_netloc = f"{parsed.scheme}://{parsed.netloc}"
-    to_visit = [start_url]
-    visited = set()
-    pages = OrderedDict()
-
+    queue = asyncio.Queue()
+    queue.put_nowait(start_url)
+    # Every URL ever queued, so each is queued at most once. Huge crawls trade exactness
+    # for memory: a rare false positive just leaves a page out of the snapshot.
+    if max_pages >= BLOOM_MIN_PAGES:
+        enqueued = BloomFilter(capacity=max_pages * 10)
+        enqueued.add(start_url)
+    else:
+        enqueued = {start_url}
+    visited_count = 0
+    results = []  # (crawl index, url, title, html_content, digest)
+    limiter = HostRateLimiter(delay)
     pbar = tqdm(total=max_pages, desc="Crawling pages", unit="page")
-    while to_visit and len(visited) < max_pages:
-        url = to_visit.pop(0)
-        if url in visited:
-            continue
+
+    robots = None
+
+    async def visit(session, pool, url):
+        nonlocal visited_count
+        if visited_count >= max_pages:
+            return
+        index = visited_count
+        visited_count += 1
         if not is_same_domain(base_netloc, url):
-            visited.add(url)
-            continue
+            return
         if allowed_path_prefix and not url.startswith(allowed_path_prefix):
-            visited.add(url)
-            continue
- #       if not allowed_by_robots(start_url, url):
-  #          print(f"[robots.txt] Skipping {url}")
-   #         visited.add(url)
-    #        continue
+            return
+        if robots is not None and not robots.can_fetch(USER_AGENT, url):
+            print(f"[robots.txt] Skipping {url}")
+            return
+        await limiter.wait(_split(url).netloc)
+        cached = page_cache.get(url) if page_cache is not None else None
         try:
-            resp = SESSION.get(url, timeout=20)
-            if resp.status_code != 200:
-                visited.add(url)
-                continue
+            async with session.get(url, headers=conditional_headers(cached)) as resp:
+                if resp.status == 304 and cached is not None:
+                    body = None  # unchanged since the last run
+                elif resp.status != 200:
+                    return
+                else:
+                    mime, charset = parse_content_type(resp.headers.get("Content-Type", ""))
+                    if not is_html_type(mime):
+                        return  # don't download bodies we would not parse
+                    body = await resp.read()
+                    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
         except Exception as e:
             print("Request failed:", e)
-            visited.add(url)
-            continue
-
-        soup = BeautifulSoup(resp.text, "html.parser")
-        # Extract title
-        title_tag = soup.find("title")
-        title = title_tag.get_text(strip=True) if title_tag else url
-        main = extract_main_html(soup)
-        if main is None:
-            visited.add(url)
-            continue
-        main = clean_html_fragment(main)
-        pages[url] = (title, str(main))
+            return
 
-        visited.add(url)
+        if body is None:
+            parsed_page = cached[2]
+        else:
+            parsed_page = await asyncio.get_running_loop().run_in_executor(
+                pool, _parse_and_clean, url, body, charset)
+            if parsed_page is None:
+                return
+            if page_cache is not None:
+                page_cache.put(url, etag, last_modified, parsed_page)
+        title, html_content, links, digest = parsed_page
+        results.append((index, url, title, html_content, digest))
         pbar.update(1)
 
         # Find internal links
-        for a in soup.find_all("a", href=True):
-            href = normalize_link(url, a['href'])
-            if not href: continue
+        for href in links:
             # keep only docs pages in same domain
             if not is_same_domain(base_netloc, href):
                 continue
             # optionally filter out file types
-            if re.search(r'\.(jpg|jpeg|png|gif|svg|pdf|zip|tar|gz|mp4|webm)$', href, re.I):
+            if _SKIP_EXT_RE.search(href):
                 continue
-            if href not in visited and href not in to_visit and href.startswith(scheme_and_netloc):
-                to_visit.append(href)
-        time.sleep(delay)
+            if href not in enqueued and href.startswith(scheme_and_netloc):
+                enqueued.add(href)
+                queue.put_nowait(href)
+
+    async def worker(session, pool):
+        while True:
+            url = await queue.get()
+            try:
+                await visit(session, pool, url)
+            except Exception as e:
+                print("Failed to process", url, e)
+            finally:
+                queue.task_done()
+
+    # Worker count bounds in-flight requests; the connector caps open sockets.
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=concurrency)
+    timeout = aiohttp.ClientTimeout(total=20)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                         headers={"User-Agent": USER_AGENT}) as session:
+            if respect_robots:
+                robots = await fetch_robot_parser(session, start_url)
+            tasks = [asyncio.create_task(worker(session, pool)) for _ in range(concurrency)]
+            await queue.join()
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
     pbar.close()
+
+    pages = OrderedDict()
+    # Duplicates are dropped in crawl order, so the earliest URL of a pair always wins
+    seen_digests = set()
+    for _, url, title, html_content, digest in sorted(results):
+        if digest not in seen_digests:
+            seen_digests.add(digest)
+            pages[url] = (title, parse_fragment(html_content))
     return pages
 
-def build_book_html(pages, book_title="Documentation Book", author=None):
+def crawl_docs(start_url, max_pages=300, delay=0.5, allowed_path_prefix=None, concurrency=8,
+               respect_robots=True, workers=None, page_cache=None):
+    """
+    Synchronous entry point for crawl_docs_async.
+    Returns OrderedDict of URL -> (title, content element)
+    """
+    return asyncio.run(crawl_docs_async(start_url, max_pages=max_pages, delay=delay,
+                                        allowed_path_prefix=allowed_path_prefix,
+                                        concurrency=concurrency,
+                                        respect_robots=respect_robots,
+                                        workers=workers, page_cache=page_cache))
+
+async def fetch_images(urls, image_dir, concurrency=8):
+    """
+    Download each image URL into image_dir, named by the sha1 of the URL, reusing
+    files left by earlier runs. Returns dict of URL -> local file URI.
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    local = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(session, src):
+        path = os.path.join(image_dir, hashlib.sha1(src.encode("utf-8")).hexdigest())
+        if not os.path.exists(path):
+            async with semaphore:
+                try:
+                    async with session.get(src) as resp:
+                        if resp.status != 200:
+                            return
+                        data = await resp.read()
+                except Exception as e:
+                    print("Image request failed:", src, e)
+                    return
+            with open(path + ".part", "wb") as f:
+                f.write(data)
+            os.replace(path + ".part", path)
+        local[src] = pathlib.Path(path).as_uri()
+
+    timeout = aiohttp.ClientTimeout(total=20)
+    async with aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": USER_AGENT}) as session:
+        await asyncio.gather(*(fetch(session, src) for src in urls))
+    return local
+
+def localize_images(pages, image_dir, concurrency=8):
+    """
+    Prefetch every remote <img> in pages concurrently and point it at the local
+    copy, so WeasyPrint does not download them one by one while rendering.
+    Images that cannot be fetched are dropped.
+    """
+    images = [img for _, content in pages.values() for img in content.iter("img")]
+    remote = {img.get("src") for img in images
+              if (img.get("src") or "").startswith(("http://", "https://"))}
+    local = asyncio.run(fetch_images(remote, image_dir, concurrency=concurrency))
+    for img in images:
+        src = img.get("src") or ""
+        if src in local:
+            img.set("src", local[src])
+        elif not src.startswith("data:"):
+            img.drop_tree()
+
+def drop_images(pages):
+    for _, content in pages.values():
+        for img in list(content.iter("img")):
+            img.drop_tree()
+
+# Constant pieces of a chapter document, written around the per-chapter values
+_CH_HEAD = '<section class="chapter" id="'
+_CH_MID1 = '">\n<h1>'
+_CH_MID2 = '</h1>\n<div class="source-url">Source: <a href="'
+_CH_MID3 = '">'
+_CH_MID4 = '</a></div>\n'
+_CH_TAIL = '</section>'
+
+def build_book_html(pages, out_dir, book_title="Documentation Book", author=None):
     """
-    Build a single HTML string that contains:
+    Write the book to out_dir as standalone HTML documents and return their paths, in order:
       - Title page
       - Table of Contents (with links)
-      - Chapters (each page content)
+      - Chapters (one document per page)
+    Each is rendered on its own and merged by save_html_to_pdf. Documents are
+    streamed to disk, so at most one chapter's markup is held in memory.
     """
-    # Generate TOC entries from headings in each page
-    toc_entries = []
-    chapters_html = []
-    for i, (url, (title, html_content)) in enumerate(pages.items(), start=1):
-        soup = BeautifulSoup(html_content, "html.parser")
-        # Ensure headings have ids
-        for h in soup.find_all(re.compile("^h[1-6]$")):
-            if not h.get('id'):
-                safe_id = re.sub(r'[^a-zA-Z0-9_-]+', '-', h.get_text())[:60]
-                h['id'] = f"p{i}-{safe_id}"
-        # Chapter heading
-        chapter_title = soup.find(re.compile("^h[1-3]$"))
-        chapter_title_text = chapter_title.get_text(strip=True) if chapter_title else title
-        chapter_id = f"chapter-{i}"
-        toc_entries.append((chapter_title_text, chapter_id))
-        # Wrap content
-        chapter_html = f'<section class="chapter" id="{chapter_id}">\n<h1>{chapter_title_text}</h1>\n<div class="source-url">Source: <a href="{url}">{url}</a></div>\n{str(soup)}</section>\n<div style="page-break-after: always;"></div>'
-        chapters_html.append(chapter_html)
-
     # Simple CSS for printing
     css = """
     body { font-family: "DejaVu Sans", "Arial", sans-serif; margin: 2cm; font-size: 12pt; color: #222; }
@@ -217,27 +575,170 @@ def build_book_html(pages, book_title="Documentation Book", author=None):
     .idx { font-size: 11pt; }
     """
 
+    # Every document starts on a new page, so no explicit page breaks are needed
+    head = f"<!doctype html><html><head><meta charset='utf-8'><title>{esc(book_title)}</title><style>{css}</style></head><body>"
+    def write_document(name, *body_parts):
+        path = os.path.join(out_dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(head)
+            f.writelines(body_parts)
+            f.write("</body></html>")
+        return path
+
     # Build HTML
-    title_html = f"<div class='title-page'><h1>{book_title}</h1>"
+    title_parts = [f"<div class='title-page'><h1>{esc(book_title)}</h1>"]
     if author:
-        title_html += f"<div class='author'>By {author}</div>"
-    title_html += f"<div class='meta'>Generated: {time.strftime('%Y-%m-%d %H:%M:%S')}</div></div><div style='page-break-after: always;'></div>"
+        title_parts.append(f"<div class='author'>By {esc(author)}</div>")
+    title_parts.append(f"<div class='meta'>Generated: {time.strftime('%Y-%m-%d %H:%M:%S')}</div></div>")
+    title_path = write_document("title.html", *title_parts)
+
+    # Generate TOC entries from headings in each page
+    toc_entries = []
+    chapter_paths = []
+    for i, (url, (title, content)) in enumerate(pages.items(), start=1):
+        # Ensure headings have ids
+        for h in content.iter(*_HEADING_TAGS):
+            if not h.get('id'):
+                safe_id = _SAFEID_RE.sub('-', h.text_content())[:60]
+                h.set('id', f"p{i}-{safe_id}")
+        # Chapter heading
+        chapter_title = next(content.iter(*_H13_TAGS), None)
+        chapter_title_text = chapter_title.text_content().strip() if chapter_title is not None else title
+        chapter_id = f"chapter-{i}"
+        toc_entries.append((chapter_title_text, chapter_id))
+        # Wrap content
+        safe_url = esc(url)
+        chapter_paths.append(write_document(
+            f"chapter-{i:05d}.html",
+            _CH_HEAD, chapter_id, _CH_MID1, esc(chapter_title_text), _CH_MID2, safe_url, _CH_MID3, safe_url,
+            _CH_MID4, serialize_fragment(content), _CH_TAIL))
+
+    toc_parts = ["<div class='toc'><h2>Index / Table of Contents</h2><ul>"]
+    toc_parts.extend(f'<li><a href="#{cid}">{esc(t)}</a></li>\n' for t, cid in toc_entries)
+    toc_parts.append("</ul></div>")
+    toc_path = write_document("toc.html", *toc_parts)
 
-    toc_html = "<div class='toc'><h2>Index / Table of Contents</h2><ul>"
-    for t, cid in toc_entries:
-        toc_html += f'<li><a href="#{cid}">{t}</a></li>\n'
-    toc_html += "</ul></div><div style='page-break-after: always;'></div>"
+    return [title_path, toc_path] + chapter_paths
+
+class _CrossDocumentAnchorFilter(logging.Filter):
+    # Links into other documents of the book are resolved when merging, not by WeasyPrint
+    def filter(self, record):
+        return not record.getMessage().startswith("No anchor #")
+
+_ANCHOR_FILTER = _CrossDocumentAnchorFilter()
+
+# Print overrides for scraped markup: break-word wrapping and automatic table
+# layout are the usual causes of runaway WeasyPrint layout times
+PRINT_CSS = """
+@page { size: A4; margin: 2cm }
+* { word-break: normal !important; }
+table { table-layout: fixed; width: 100%; }
+"""
 
-    body_html = "\n".join(chapters_html)
+# Recompress embedded images; decoded images are shared between all documents a
+# worker process renders
+_IMAGE_CACHE = {}
+_RENDER_OPTIONS = {"optimize_images": True, "jpeg_quality": 85, "cache": _IMAGE_CACHE}
 
-    full_html = f"<!doctype html><html><head><meta charset='utf-8'><title>{book_title}</title><style>{css}</style></head><body>{title_html}{toc_html}{body_html}</body></html>"
-    return full_html
+@functools.lru_cache(maxsize=None)
+def _print_stylesheet():
+    # Parsed once per worker process
+    return CSS(string=PRINT_CSS)
 
-def save_html_to_pdf(html_str, output_path, base_url=None):
+def _render_document(path, base_url=None):
     """
-    Convert HTML string to PDF using WeasyPrint.
+    Render one standalone HTML file with WeasyPrint, in a worker process.
+    Returns (pdf_bytes, anchors, links) where anchors maps anchor name -> (page, x, y)
+    and links lists (page, target anchor, (x1, y1, x2, y2)) for internal links; positions
+    are in PDF points from the bottom-left of the page.
     """
-    HTML(string=html_str, base_url=base_url).write_pdf(output_path, stylesheets=[CSS(string='@page { size: A4; margin: 2cm }')])
+    logging.getLogger("weasyprint").addFilter(_ANCHOR_FILTER)
+    options = dict(_RENDER_OPTIONS, stylesheets=[_print_stylesheet()])
+    doc = HTML(filename=path, base_url=base_url).render(**options)
+    anchors = {}
+    links = []
+    for page_index, page in enumerate(doc.pages):
+        # 0.75 = 72 PDF points per inch / 96 CSS pixels per inch
+        height = page.height * 0.75
+        for name, pos in page.anchors.items():
+            anchors.setdefault(name, (page_index, pos[0] * 0.75, height - pos[1] * 0.75))
+        # Link rectangles are (x1, y1, x2, y2) corners in CSS pixels from the top-left
+        for link_type, target, (x1, y1, x2, y2), *_ in page.links:
+            if link_type == "internal":
+                rect = (x1 * 0.75, height - y2 * 0.75, x2 * 0.75, height - y1 * 0.75)
+                links.append((page_index, target, rect))
+    return doc.write_pdf(**options), anchors, links
+
+def save_html_to_pdf(documents, output_path, base_url=None, workers=None):
+    """
+    Render each HTML file in `documents` in a pool of `workers` processes (WeasyPrint is
+    single-threaded and slows down on very large documents), then merge the PDFs
+    in order with pypdf, re-creating links that point into another document.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        rendered = list(pool.map(_render_document, documents, itertools.repeat(base_url)))
+
+    writer = PdfWriter()
+    anchors = {}
+    offsets = []
+    for pdf_bytes, doc_anchors, _ in rendered:
+        offset = len(writer.pages)
+        offsets.append(offset)
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        if offset == 0 and reader.metadata:
+            writer.add_metadata(reader.metadata)
+        writer.append(reader)
+        for name, (page_index, x, y) in doc_anchors.items():
+            anchors.setdefault(name, (offset + page_index, x, y))
+    for offset, (_, doc_anchors, links) in zip(offsets, rendered):
+        for page_index, target, rect in links:
+            if target in doc_anchors or target not in anchors:
+                continue  # same-document links are already in the PDF
+            target_page, x, y = anchors[target]
+            writer.add_annotation(offset + page_index, Link(rect=rect, target_page_index=target_page,
+                                                              fit=Fit.xyz(left=x, top=y)))
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+def fetch_pages(urls, delay=0.5, respect_robots=True, page_cache=None):
+    """
+    Fetch an explicit list of pages, one after another.
+    Returns OrderedDict of URL -> (title, content element)
+    """
+    pages = OrderedDict()
+    seen_digests = set()
+    for u in urls:
+        if respect_robots and not allowed_by_robots(u, u):
+            print(f"[robots.txt] Skipping {u}")
+            continue
+        print("Fetching", u)
+        try:
+            cached = page_cache.get(u) if page_cache is not None else None
+            with SESSION.get(u, timeout=20, stream=True, headers=conditional_headers(cached)) as resp:
+                if resp.status_code == 304 and cached is not None:
+                    parsed_page = cached[2]  # unchanged since the last run
+                elif resp.status_code != 200:
+                    print("Skipped:", u, "status", resp.status_code)
+                    continue
+                else:
+                    mime, charset = parse_content_type(resp.headers.get("Content-Type", ""))
+                    if not is_html_type(mime):
+                        print("Skipped:", u, "content type", mime)
+                        continue
+                    parsed_page = _parse_and_clean(u, resp.content, charset)
+                    if parsed_page is not None and page_cache is not None:
+                        page_cache.put(u, resp.headers.get("ETag"), resp.headers.get("Last-Modified"), parsed_page)
+            if parsed_page is not None:
+                title, html_content, _, digest = parsed_page
+                if digest in seen_digests:
+                    print("Skipped:", u, "duplicate content")
+                else:
+                    seen_digests.add(digest)
+                    pages[u] = (title, parse_fragment(html_content))
+            time.sleep(delay)
+        except Exception as e:
+            print("Error fetching", u, e)
+    return pages
 
 # -------------------- Commandline interface --------------------
 
@@ -246,49 +747,53 @@ def main():
     parser.add_argument("--start-url", "-s", required=False, default="https://docs.flutter.dev", help="Starting URL for the documentation (default: https://docs.flutter.dev)")
     parser.add_argument("--output", "-o", required=False, default="documentation_book.pdf", help="Output PDF filename (default: documentation_book.pdf)")
     parser.add_argument("--max-pages", type=int, default=200, help="Maximum number of pages to crawl (default: 200)")
-    parser.add_argument("--delay", type=float, default=0.4, help="Delay between requests in seconds (default: 0.4)")
+    parser.add_argument("--delay", type=float, default=0.4, help="Minimum delay between requests to the same host in seconds (default: 0.4)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of concurrent crawl workers (default: 8)")
     parser.add_argument("--no-crawl", action="store_true", help="If set, do not crawl; instead expect --urls-file with list of pages to include")
     parser.add_argument("--urls-file", help="A file containing newline-separated URLs to include (used with --no-crawl)")
     parser.add_argument("--book-title", default="Documentation Book", help="Title to put on the PDF book")
     parser.add_argument("--author", default=None, help="Author/creator name for the title page")
     parser.add_argument("--allowed-prefix", default=None, help="Only include URLs that start with this prefix (useful to limit to /docs/)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes for parsing pages and rendering the PDF (default: CPU count)")
+    parser.add_argument("--no-images", action="store_true", help="Leave images out of the book")
+    parser.add_argument("--cache-dir", default=None, help="Directory for downloaded images and cached pages (default: .docsnap_cache next to the output PDF)")
+    parser.add_argument("--no-cache", action="store_true", help="Re-download every page instead of revalidating the copies cached by earlier runs")
+    parser.add_argument("--ignore-robots", action="store_true", help="Do not check robots.txt before fetching pages")
     args = parser.parse_args()
+    out = os.path.abspath(args.output)
+    cache_dir = args.cache_dir or os.path.join(os.path.dirname(out), ".docsnap_cache")
 
-    if args.no_crawl:
-        if not args.urls_file:
-            print("When --no-crawl is used you must provide --urls-file with URLs to include.")
-            sys.exit(1)
-        with open(args.urls_file, "r", encoding="utf-8") as f:
-            urls = [u.strip() for u in f if u.strip()]
-        pages = OrderedDict()
-        for u in urls:
-            print("Fetching", u)
-            try:
-                resp = SESSION.get(u, timeout=20)
-                if resp.status_code != 200:
-                    print("Skipped:", u, "status", resp.status_code)
-                    continue
-                soup = BeautifulSoup(resp.text, "html.parser")
-                title_tag = soup.find("title")
-                title = title_tag.get_text(strip=True) if title_tag else u
-                main = extract_main_html(soup)
-                main = clean_html_fragment(main)
-                pages[u] = (title, str(main))
-                time.sleep(args.delay)
-            except Exception as e:
-                print("Error fetching", u, e)
-    else:
-        pages = crawl_docs(args.start_url, max_pages=args.max_pages, delay=args.delay, allowed_path_prefix=args.allowed_prefix)
+    if args.no_crawl and not args.urls_file:
+        print("When --no-crawl is used you must provide --urls-file with URLs to include.")
+        sys.exit(1)
+    page_cache = None if args.no_cache else PageCache(os.path.join(cache_dir, "pages.sqlite"))
+    try:
+        if args.no_crawl:
+            with open(args.urls_file, "r", encoding="utf-8") as f:
+                urls = [u.strip() for u in f if u.strip()]
+            pages = fetch_pages(urls, delay=args.delay, respect_robots=not args.ignore_robots, page_cache=page_cache)
+        else:
+            pages = crawl_docs(args.start_url, max_pages=args.max_pages, delay=args.delay, allowed_path_prefix=args.allowed_prefix, concurrency=args.concurrency,
+                               respect_robots=not args.ignore_robots, workers=args.workers, page_cache=page_cache)
+    finally:
+        if page_cache is not None:
+            page_cache.close()
 
     if not pages:
         print("No pages collected. Exiting.")
         sys.exit(1)
 
+    if args.no_images:
+        drop_images(pages)
+    else:
+        print("Fetching images...")
+        localize_images(pages, os.path.join(cache_dir, "images"), concurrency=args.concurrency)
+
     print(f"Building book HTML with {len(pages)} pages...")
-    html_str = build_book_html(pages, book_title=args.book_title, author=args.author)
-    out = os.path.abspath(args.output)
-    print("Converting to PDF (this may take a while)...")
-    save_html_to_pdf(html_str, out, base_url=args.start_url)
+    with tempfile.TemporaryDirectory(prefix="docsnap-") as html_dir:
+        documents = build_book_html(pages, html_dir, book_title=args.book_title, author=args.author)
+        print("Converting to PDF (this may take a while)...")
+        save_html_to_pdf(documents, out, base_url=args.start_url, workers=args.workers)
     print("Done. PDF saved to:", out)
 
 if __name__ == "__main__":